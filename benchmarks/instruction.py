@@ -0,0 +1,50 @@
+"""
+Benchmark guacamole.instruction import time and encode/decode calls.
+
+Usage:
+
+    $ PYTHONPATH=. python benchmarks/instruction.py
+"""
+
+import subprocess
+import sys
+import timeit
+
+
+IMPORT_RUNS = 20
+CALLS = 100000
+
+IMPORT_STMT = (
+    'import time; t = time.time(); import guacamole.instruction; '
+    'print(time.time() - t)'
+)
+
+SETUP = '''
+from guacamole.instruction import GuacamoleInstruction as Instruction
+mouse = Instruction('mouse', 400, 500, 0)
+encoded = mouse.encode()
+'''
+
+
+def bench_import():
+    timings = []
+    for _ in range(IMPORT_RUNS):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_STMT])
+        timings.append(float(output))
+    return min(timings)
+
+
+def bench_call(stmt):
+    timer = timeit.Timer(stmt, setup=SETUP)
+    return min(timer.repeat(3, CALLS)) / CALLS
+
+
+def main():
+    print('import guacamole.instruction: %8.2f ms' % (bench_import() * 1e3))
+
+    for stmt in ('mouse.encode()', 'Instruction.load(encoded)'):
+        print('%-28s %8.2f us' % (stmt + ':', bench_call(stmt) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2014 - 2016 Mohab Usama
+"""
+
+import threading
+
+
+class HandshakeCache(object):
+    """
+    Cache of `args` instructions received from guacd during handshake.
+
+    The parameter list guacd sends for a protocol does not change unless
+    guacd itself changes, so a cached list allows the client to send its
+    `connect` instruction without waiting for the `args` round-trip.
+
+    Entries are keyed by (host, port, protocol). The cached value is the
+    full `args` list, including the version string guacd advertises as its
+    first element (e.g. `VERSION_1_1_0`). An upgraded guacd therefore never
+    matches a stale entry: the client validates the real `args` against the
+    cached one and falls back to a regular handshake on mismatch.
+
+    A single cache can be shared among many clients and threads.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(host, port, protocol):
+        """
+        Return cache key for a guacd endpoint and protocol.
+        """
+        return (host, port, protocol)
+
+    def get(self, key):
+        """
+        Return cached `args` list or None.
+        """
+        with self._lock:
+            return self._entries.get(key)
+
+    def set(self, key, args):
+        """
+        Store `args` list received from guacd.
+        """
+        with self._lock:
+            self._entries[key] = tuple(args)
+
+    def invalidate(self, key):
+        """
+        Remove cached `args` list (if any).
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all cached entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    @staticmethod
+    def version(args):
+        """
+        Return guacd protocol version advertised in `args` list, if any.
+        """
+        if args and args[0].startswith('VERSION_'):
+            return args[0]
+        return None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -7,6 +7,9 @@ Copyright (c)   2014 rescale
 
 import socket
 import logging
+import threading
+
+from collections import deque
 
 from guacamole import logger as guac_logger
 
@@ -24,9 +27,28 @@ BUF_LEN = 4096
 
 
 class GuacamoleClient(object):
-    """Guacamole Client class."""
-
-    def __init__(self, host, port, timeout=20, debug=False, logger=None):
+    """
+    Guacamole Client class.
+
+    Concurrency: one thread may read (`receive`, `read_instruction`) while
+    another thread writes (`send`, `send_instruction`). Readers and writers
+    are serialized among themselves by separate locks, so a large read never
+    holds up input being sent to guacd. Only `handshake` opens a connection
+    (atomically); once `close` was called, reads return None and writes raise
+    GuacamoleError until the next handshake. `close` may be called from any
+    thread: it does not wait for pending reads or writes, and wakes up a
+    reader blocked on the socket.
+
+    `handshake` should complete before starting concurrent reads and writes.
+
+    send_pipeline filters may hold instructions back (e.g. MouseCoalescer).
+    Held instructions are released by the next `send`, or by the next
+    `receive` once due. Call `flush` to release them right away, e.g. when
+    browser input goes idle while guacd sends nothing.
+    """
+
+    def __init__(self, host, port, timeout=20, debug=False, logger=None,
+                 args_cache=None, send_pipeline=None, receive_pipeline=None):
         """
         Guacamole Client class. This class can handle communication with guacd
         server.
@@ -38,18 +60,42 @@ class GuacamoleClient(object):
         :param timeout: socket connection timeout.
 
         :param debug: if True, default logger will switch to Debug level.
+
+        :param args_cache: optional HandshakeCache. If provided, handshake
+            sends `connect` without waiting for guacd `args` whenever the
+            protocol args are already cached.
+
+        :param send_pipeline: optional Pipeline, filtering instructions sent
+            to guacd.
+
+        :param receive_pipeline: optional Pipeline, filtering instructions
+            received from guacd.
         """
         self.host = host
         self.port = port
         self.timeout = timeout
 
+        self.args_cache = args_cache
+
+        self.send_pipeline = send_pipeline
+        self.receive_pipeline = receive_pipeline
+
         self._client = None
 
+        # guards socket creation and teardown only (never held during I/O)
+        self._connect_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
         # handshake established?
         self.connected = False
 
-        # Receiving buffer
+        # Receiving buffer, and the socket it was filled from
         self._buffer = bytearray()
+        self._buffer_client = None
+
+        # Received instructions already filtered by receive_pipeline
+        self._received = deque()
 
         # Client ID
         self._id = None
@@ -66,13 +112,27 @@ class GuacamoleClient(object):
         """
         Socket connection.
         """
-        if not self._client:
-            self._client = socket.create_connection(
-                (self.host, self.port), self.timeout)
-            self.logger.info('Client connected with guacd server (%s, %s, %s)'
-                             % (self.host, self.port, self.timeout))
+        client = self._client
+        if client:
+            return client
+
+        with self._connect_lock:
+            if not self._client:
+                self._client = socket.create_connection(
+                    (self.host, self.port), self.timeout)
+                self.logger.info(
+                    'Client connected with guacd server (%s, %s, %s)'
+                    % (self.host, self.port, self.timeout))
+
+            return self._client
 
-        return self._client
+    def _get_client(self):
+        """
+        Return current socket connection (None if not connected), without
+        connecting.
+        """
+        with self._connect_lock:
+            return self._client
 
     @property
     def id(self):
@@ -83,15 +143,51 @@ class GuacamoleClient(object):
         """
         Terminate connection with Guacamole guacd server.
         """
-        self.client.close()
-        self._client = None
-        self.connected = False
+        with self._connect_lock:
+            client, self._client = self._client, None
+            self.connected = False
+
+        if not client:
+            return
+
+        try:
+            # wake up any thread blocked on `recv`
+            client.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+        client.close()
         self.logger.info('Connection closed.')
 
     def receive(self):
         """
         Receive instructions from Guacamole guacd server.
         """
+        self._release_held()
+
+        with self._read_lock:
+            client = self._get_client()
+            if client is None:
+                return None
+
+            if client is not self._buffer_client:
+                # new connection, drop any leftovers of the previous one.
+                self._buffer = bytearray()
+                self._received.clear()
+                self._buffer_client = client
+
+            if self.receive_pipeline is None:
+                return self._receive(client)
+
+            while not self._received:
+                line = self._receive(client)
+                if line is None:
+                    return None
+                self._received.extend(self.receive_pipeline.process(line))
+
+            return self._received.popleft()
+
+    def _receive(self, client):
         start = 0
 
         while True:
@@ -105,8 +201,17 @@ class GuacamoleClient(object):
             else:
                 start = len(self._buffer)
                 # we are still waiting for instruction termination
-                buf = self.client.recv(BUF_LEN)
+                try:
+                    buf = client.recv(BUF_LEN)
+                except socket.error:
+                    if client is not self._client:
+                        # closed by another thread
+                        return None
+                    raise
+
                 if not buf:
+                    if client is not self._client:
+                        return None
                     # No data recieved, connection lost?!
                     self.close()
                     self.logger.warn(
@@ -119,14 +224,73 @@ class GuacamoleClient(object):
         Send encoded instructions to Guacamole guacd server.
         """
         self.logger.debug('Sending data: %s' % data)
-        self.client.sendall(data.encode())
+        with self._write_lock:
+            if self.send_pipeline is not None:
+                data = ''.join(self.send_pipeline.process(data))
+                if not data:
+                    return
+            self._sendall(data)
+
+    def flush(self):
+        """
+        Send instructions held by send_pipeline filters (e.g. coalesced mouse
+        moves) right away.
+        """
+        if self.send_pipeline is None:
+            return
+
+        with self._write_lock:
+            data = ''.join(self.send_pipeline.flush())
+            if data:
+                self.logger.debug('Sending data: %s' % data)
+                self._sendall(data)
+
+    def _release_held(self):
+        """
+        Send instructions held by send_pipeline filters for long enough
+        (e.g. last mouse move once coalescing interval elapsed).
+        """
+        if self.send_pipeline is None or self._get_client() is None:
+            return
+
+        # never wait for a writer: it releases held instructions itself.
+        if not self._write_lock.acquire(False):
+            return
+
+        try:
+            data = ''.join(self.send_pipeline.poll())
+            if data:
+                self.logger.debug('Sending data: %s' % data)
+                self._sendall(data)
+        except (GuacamoleError, socket.error) as e:
+            # connection lost, reported by `receive` itself.
+            self.logger.debug('Failed to send held instructions: %s' % e)
+        finally:
+            self._write_lock.release()
+
+    def _sendall(self, data):
+        client = self._get_client()
+        if client is None:
+            raise GuacamoleError('Cannot send instruction. Connection closed.')
+
+        try:
+            client.sendall(data.encode())
+        except socket.error:
+            if client is not self._client:
+                # closed by another thread
+                raise GuacamoleError(
+                    'Cannot send instruction. Connection closed.')
+            raise
 
     def read_instruction(self):
         """
-        Read and decode instruction.
+        Read and decode instruction. Return None if connection was lost.
         """
         self.logger.debug('Reading instruction.')
-        return Instruction.load(self.receive())
+        line = self.receive()
+        if line is None:
+            return None
+        return Instruction.load(line)
 
     def send_instruction(self, instruction):
         """
@@ -157,6 +321,25 @@ class GuacamoleClient(object):
         if image is None:
             image = list()
 
+        # open connection
+        self.client
+
+        # `connect` args (kwargs are kept as-is, for a possible retry)
+        connect_kwargs = dict(kwargs)
+        if width_override:
+            connect_kwargs["width"] = width_override
+        if height_override:
+            connect_kwargs["height"] = height_override
+        if dpi_override:
+            connect_kwargs["dpi"] = dpi_override
+
+        # Cached `args` are only used for new connections (not joining).
+        cache_key = None
+        cached_args = None
+        if self.args_cache is not None and 'connectionid' not in kwargs:
+            cache_key = self.args_cache.key(self.host, self.port, protocol)
+            cached_args = self.args_cache.get(cache_key)
+
         # 1. Send 'select' instruction
         self.logger.debug('Send `select` instruction.')
 
@@ -167,6 +350,13 @@ class GuacamoleClient(object):
         else:
             self.send_instruction(Instruction('select', protocol))
 
+        if cached_args is not None:
+            # Speculative: respond to `args` before actually receiving it.
+            self.logger.debug('Using cached `args` instruction: %s'
+                              % (cached_args,))
+            self._send_connect(cached_args, width, height, dpi, audio, video,
+                               image, connect_kwargs)
+
         # 2. Receive `args` instruction
         instruction = self.read_instruction()
         self.logger.debug('Expecting `args` instruction, received: %s'
@@ -183,6 +373,58 @@ class GuacamoleClient(object):
                 'Cannot establish Handshake. Expected opcode `args`, '
                 'received `%s` instead.' % instruction.opcode)
 
+        if cached_args is not None:
+            if tuple(instruction.args) != cached_args:
+                # `connect` was sent with wrong args - start over on a new
+                # connection without speculation.
+                self.logger.warning(
+                    'Cached `args` instruction mismatch (%s != %s), guacd '
+                    'version %s (cached %s). Retrying handshake.'
+                    % (cached_args, instruction.args,
+                       self.args_cache.version(instruction.args),
+                       self.args_cache.version(cached_args)))
+                self.args_cache.invalidate(cache_key)
+                self.close()
+                return self.handshake(protocol=protocol, width=width,
+                                      height=height, dpi=dpi, audio=audio,
+                                      video=video, image=image,
+                                      width_override=width_override,
+                                      height_override=height_override,
+                                      dpi_override=dpi_override, **kwargs)
+        else:
+            if cache_key is not None:
+                self.args_cache.set(cache_key, instruction.args)
+
+            self._send_connect(instruction.args, width, height, dpi, audio,
+                               video, image, connect_kwargs)
+
+        # 5. Receive ``ready`` instruction, with client ID.
+        instruction = self.read_instruction()
+        self.logger.debug('Expecting `ready` instruction, received: %s'
+                          % str(instruction))
+
+        if not instruction:
+            self.close()
+            raise GuacamoleError(
+                'Cannot establish Handshake. Connection Lost!')
+
+        if instruction.opcode != 'ready':
+            self.logger.warning(
+                'Expected `ready` instruction, received: %s instead')
+
+        if instruction.args:
+            self._id = instruction.args[0]
+            self.logger.debug(
+                'Established connection with client id: %s' % self.id)
+
+        self.logger.debug('Handshake completed.')
+        self.connected = True
+
+    def _send_connect(self, args, width, height, dpi, audio, video, image,
+                      kwargs):
+        """
+        Send handshake response to `args` instruction.
+        """
         # 3. Respond with size, audio & video support
         self.logger.debug('Send `size` instruction (%s, %s, %s)'
                           % (width, height, dpi))
@@ -197,34 +439,10 @@ class GuacamoleClient(object):
         self.logger.debug('Send `image` instruction (%s)' % image)
         self.send_instruction(Instruction('image', *image))
 
-        if width_override:
-            kwargs["width"] = width_override
-        if height_override:
-            kwargs["height"] = height_override
-        if dpi_override:
-            kwargs["dpi"] = dpi_override
-
         # 4. Send `connect` instruction with proper values
         connection_args = [
-            kwargs.get(arg.replace('-', '_'), '') for arg in instruction.args
+            kwargs.get(arg.replace('-', '_'), '') for arg in args
         ]
 
         self.logger.debug('Send `connect` instruction (%s)' % connection_args)
         self.send_instruction(Instruction('connect', *connection_args))
-
-        # 5. Receive ``ready`` instruction, with client ID.
-        instruction = self.read_instruction()
-        self.logger.debug('Expecting `ready` instruction, received: %s'
-                          % str(instruction))
-
-        if instruction.opcode != 'ready':
-            self.logger.warning(
-                'Expected `ready` instruction, received: %s instead')
-
-        if instruction.args:
-            self._id = instruction.args[0]
-            self.logger.debug(
-                'Established connection with client id: %s' % self.id)
-
-        self.logger.debug('Handshake completed.')
-        self.connected = True
@@ -0,0 +1,441 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2014 - 2016 Mohab Usama
+"""
+
+import base64
+import io
+
+try:
+    from PIL import Image, ImageMath
+except ImportError:  # pragma: no cover
+    Image = ImageMath = None
+
+
+# default (visible) layer
+DEFAULT_LAYER = 0
+
+# Channel masks (composite operations) fully supported. Any other mask is
+# drawn as OVER.
+MASK_SRC = 0xC
+MASK_OVER = 0xE
+
+# Max size (bytes) of data queued by a buffer before it is drawn anyway.
+# Buffers (e.g. cursor) are often drawn into without ever being queried.
+MAX_BUFFER_PENDING = 4 * 1024 * 1024
+
+# Transfer functions handled without pixel arithmetic.
+TRANSFER_SRC = 0x3
+TRANSFER_DEST = 0x5
+
+
+# Transfer functions, as bitwise operations on source and destination.
+TRANSFER_FUNCTIONS = {
+    0x0: lambda s, d: s ^ s,
+    0x1: lambda s, d: s & d,
+    0x2: lambda s, d: s & ~d,
+    0x3: lambda s, d: s,
+    0x4: lambda s, d: ~s & d,
+    0x5: lambda s, d: d,
+    0x6: lambda s, d: s ^ d,
+    0x7: lambda s, d: s | d,
+    0x8: lambda s, d: ~(s | d),
+    0x9: lambda s, d: ~(s ^ d),
+    0xA: lambda s, d: ~d,
+    0xB: lambda s, d: s | ~d,
+    0xC: lambda s, d: ~s,
+    0xD: lambda s, d: ~s | d,
+    0xE: lambda s, d: ~(s & d),
+    0xF: lambda s, d: ~(s ^ s),
+}
+
+
+class Layer(object):
+    """
+    Display layer (or off-screen buffer, if index is negative).
+
+    Drawing operations are queued, and only applied once the layer content
+    is needed (i.e. queried, or used as source of `copy` / `transfer`).
+
+    Queued operations are dropped as soon as a later operation fully
+    replaces the area they draw (e.g. a `cfill` or `img` with SRC mask), so
+    the queue of a layer nobody queries stays bounded as long as its content
+    keeps being redrawn. Buffers are also drawn once their queued data
+    exceeds MAX_BUFFER_PENDING bytes.
+    """
+
+    def __init__(self, index, width=0, height=0):
+        self.index = index
+        self.width = width
+        self.height = height
+
+        # number of operations ever queued (used to detect changes)
+        self.version = 0
+
+        self._image = None
+        self._pending = []
+        self._pending_bytes = 0
+
+        # rects of current path, consumed by `cfill`
+        self.path = []
+
+    @property
+    def autosize(self):
+        """Buffers grow to fit whatever is drawn in them."""
+        return self.index < 0
+
+    @property
+    def image(self):
+        """
+        Return up to date layer image (RGBA).
+        """
+        self.flush()
+        return self._image
+
+    def queue(self, op, rect, replaces, *args):
+        """
+        Queue drawing operation.
+
+        :param op: operation name (Layer method, without leading `_`).
+
+        :param rect: (x, y, width, height) area drawn by operation, or None
+            if unknown (or not a drawing operation).
+
+        :param replaces: True if operation replaces every pixel of `rect`,
+            regardless of current layer content.
+        """
+        if replaces and rect is not None:
+            # drop operations whose result would be entirely overwritten.
+            # This holds for buffers too: this operation grows a buffer at
+            # least as much as the dropped ones would have.
+            self._prune(lambda pending: not _contains(rect, pending))
+
+        size = sum(_data_size(arg) for arg in args)
+        self._pending.append((op, rect, args, size))
+        self._pending_bytes += size
+        self.version += 1
+
+        if self.autosize and self._pending_bytes > MAX_BUFFER_PENDING:
+            self.flush()
+
+    def clip(self, width, height):
+        """
+        Drop queued operations drawing outside of (width, height) only, as
+        resizing layer discards their result anyway.
+        """
+        self._prune(lambda pending: pending is None or _intersects(
+            (0, 0, width, height), pending))
+
+    def _prune(self, keep):
+        """
+        Drop queued operations for which `keep(rect)` is False.
+        """
+        self._pending = [
+            pending for pending in self._pending if keep(pending[1])
+        ]
+        self._pending_bytes = sum(pending[3] for pending in self._pending)
+
+    def flush(self):
+        """
+        Apply all pending drawing operations.
+        """
+        if self._image is None:
+            self._image = Image.new('RGBA', (0, 0))
+
+        pending, self._pending = self._pending, []
+        self._pending_bytes = 0
+        for op, _, args, _ in pending:
+            getattr(self, '_' + op)(*args)
+
+    def crop(self, x, y, width, height):
+        """
+        Return a copy of layer content in given rect.
+        """
+        return self.image.crop((x, y, x + width, y + height))
+
+    def _fit(self, x, y, width, height):
+        if not self.autosize:
+            return
+
+        current = self._image.size
+        size = (max(current[0], x + width), max(current[1], y + height))
+        if size != current:
+            self._size(*size)
+            self.width = max(self.width, size[0])
+            self.height = max(self.height, size[1])
+
+    def _size(self, width, height):
+        image = Image.new('RGBA', (width, height))
+        image.paste(self._image, (0, 0))
+        self._image = image
+
+    def _draw(self, src, x, y, mask):
+        self._fit(x, y, src.width, src.height)
+
+        if x < 0 or y < 0:
+            src = src.crop((max(-x, 0), max(-y, 0), src.width, src.height))
+            x, y = max(x, 0), max(y, 0)
+
+        if mask == MASK_SRC:
+            self._image.paste(src, (x, y))
+        else:
+            self._image.alpha_composite(src, (x, y))
+
+    def _img(self, mask, x, y, blobs):
+        data = b''.join(base64.b64decode(blob) for blob in blobs)
+        src = Image.open(io.BytesIO(data)).convert('RGBA')
+        self._draw(src, x, y, mask)
+
+    def _paste(self, mask, x, y, src):
+        self._draw(src, x, y, mask)
+
+    def _fill(self, mask, rects, color):
+        for x, y, width, height in rects:
+            self._fit(x, y, width, height)
+            if mask == MASK_SRC or color[3] == 0xFF:
+                self._image.paste(color, (x, y, x + width, y + height))
+            else:
+                self._draw(
+                    Image.new('RGBA', (width, height), color), x, y, mask)
+
+    def _transfer(self, function, x, y, src):
+        if function == TRANSFER_SRC:
+            return self._draw(src, x, y, MASK_SRC)
+
+        self._fit(x, y, src.width, src.height)
+
+        box = (x, y, x + src.width, y + src.height)
+        dst = self._image.crop(box)
+
+        # Each RGBA pixel is handled as a single 32-bit int, the transfer
+        # function being applied bitwise.
+        result = _image_math(
+            TRANSFER_FUNCTIONS[function & 0xF],
+            Image.frombytes('I', src.size, src.tobytes()),
+            Image.frombytes('I', dst.size, dst.tobytes()))
+
+        image = Image.frombytes('RGBA', dst.size, result.tobytes())
+
+        # only color channels are affected
+        image.putalpha(dst.getchannel('A'))
+        self._image.paste(image, box)
+
+
+def _contains(outer, inner):
+    """
+    Return True if rect `inner` is within rect `outer`.
+    """
+    if inner is None:
+        return False
+
+    x, y, width, height = inner
+    return (outer[0] <= x and outer[1] <= y and
+            x + width <= outer[0] + outer[2] and
+            y + height <= outer[1] + outer[3])
+
+
+def _data_size(arg):
+    """
+    Return approximate memory size (bytes) of queued operation arg.
+    """
+    if isinstance(arg, list):
+        # image stream blobs
+        return sum(len(blob) for blob in arg)
+    if Image is not None and isinstance(arg, Image.Image):
+        return arg.width * arg.height * 4
+    return 0
+
+
+def _intersects(rect, other):
+    """
+    Return True if rects overlap.
+    """
+    return (other[0] < rect[0] + rect[2] and rect[0] < other[0] + other[2] and
+            other[1] < rect[1] + rect[3] and rect[1] < other[1] + other[3])
+
+
+def _image_math(func, s, d):
+    """
+    Return image computed by `func(s, d)` (ImageMath operands).
+    """
+    if hasattr(ImageMath, 'lambda_eval'):
+        return ImageMath.lambda_eval(lambda args: func(args['s'], args['d']),
+                                     s=s, d=d)
+    return ImageMath.eval('func(s, d)', func=func, s=s, d=d)
+
+
+def _image_size(blobs):
+    """
+    Return (width, height) of an image stream, parsing its header only.
+    """
+    try:
+        return Image.open(io.BytesIO(base64.b64decode(blobs[0]))).size
+    except Exception:
+        return None
+
+
+class GuacamoleDisplay(object):
+    """
+    Headless display state, built from guacd instructions.
+
+    Instructions are applied incrementally via `apply`. Drawing is deferred
+    per layer, so layers that are never queried (nor copied from) cost
+    little more than queuing their instructions: image blobs are not even
+    decoded.
+
+    Supported instructions: `size`, `img` + `blob` + `end`, `copy`, `rect`
+    + `cfill`, `transfer` and `dispose`. Other instructions are ignored.
+
+    Requires Pillow.
+    """
+
+    def __init__(self):
+        if Image is None:
+            raise ImportError('GuacamoleDisplay requires Pillow.')
+
+        self.layers = {}
+
+        # open image streams: index -> (layer, mask, mimetype, x, y, blobs)
+        self._streams = {}
+
+        # last rendered thumbnail: (key, image)
+        self._thumbnail = None
+
+        self._handlers = {
+            'size': self._size,
+            'img': self._img,
+            'blob': self._blob,
+            'end': self._end,
+            'copy': self._copy,
+            'transfer': self._transfer,
+            'rect': self._rect,
+            'cfill': self._cfill,
+            'dispose': self._dispose,
+        }
+
+    def layer(self, index):
+        """
+        Return layer by index (created if missing).
+        """
+        index = int(index)
+        layer = self.layers.get(index)
+        if layer is None:
+            layer = self.layers[index] = Layer(index)
+        return layer
+
+    @property
+    def width(self):
+        return self.layer(DEFAULT_LAYER).width
+
+    @property
+    def height(self):
+        return self.layer(DEFAULT_LAYER).height
+
+    def apply(self, instruction):
+        """
+        Apply GuacamoleInstruction to display state.
+        """
+        handler = self._handlers.get(instruction.opcode)
+        if handler:
+            handler(*instruction.args)
+
+    def screenshot(self, layer=DEFAULT_LAYER):
+        """
+        Return up to date PIL image of layer.
+        """
+        return self.layer(layer).image.copy()
+
+    def thumbnail(self, width, height, layer=DEFAULT_LAYER):
+        """
+        Return downscaled PIL image of layer, fitting in (width, height) and
+        preserving aspect ratio.
+
+        Rendering is skipped if layer did not change since last thumbnail.
+        """
+        layer = self.layer(layer)
+        key = (layer.index, layer.version, layer.width, layer.height,
+               width, height)
+
+        if self._thumbnail is None or self._thumbnail[0] != key:
+            image = layer.image.copy()
+            image.thumbnail((width, height))
+            self._thumbnail = (key, image)
+
+        return self._thumbnail[1]
+
+    def _size(self, layer, width, height):
+        layer = self.layer(layer)
+        layer.width, layer.height = int(width), int(height)
+        layer.clip(layer.width, layer.height)
+        layer.queue('size', None, False, layer.width, layer.height)
+
+    def _img(self, stream, mask, layer, mimetype, x, y):
+        self._streams[stream] = (
+            self.layer(layer), int(mask), mimetype, int(x), int(y), [])
+
+    def _blob(self, stream, data):
+        if stream in self._streams:
+            self._streams[stream][5].append(data)
+
+    def _end(self, stream):
+        if stream not in self._streams:
+            return
+
+        layer, mask, mimetype, x, y, blobs = self._streams.pop(stream)
+
+        rect = None
+        size = _image_size(blobs) if blobs else None
+        if size:
+            rect = (x, y) + size
+
+        # JPEG images have no alpha channel
+        replaces = mask == MASK_SRC or mimetype == 'image/jpeg'
+        layer.queue('img', rect, replaces, mask, x, y, blobs)
+
+    def _copy(self, src_layer, src_x, src_y, src_width, src_height, mask,
+              dst_layer, dst_x, dst_y):
+        src = self.layer(src_layer).crop(
+            int(src_x), int(src_y), int(src_width), int(src_height))
+        mask, dst_x, dst_y = int(mask), int(dst_x), int(dst_y)
+        self.layer(dst_layer).queue(
+            'paste', (dst_x, dst_y) + src.size, mask == MASK_SRC,
+            mask, dst_x, dst_y, src)
+
+    def _transfer(self, src_layer, src_x, src_y, src_width, src_height,
+                  function, dst_layer, dst_x, dst_y):
+        function = int(function)
+        if function == TRANSFER_DEST:
+            return
+
+        src = self.layer(src_layer).crop(
+            int(src_x), int(src_y), int(src_width), int(src_height))
+        dst_x, dst_y = int(dst_x), int(dst_y)
+        self.layer(dst_layer).queue(
+            'transfer', (dst_x, dst_y) + src.size, function == TRANSFER_SRC,
+            function, dst_x, dst_y, src)
+
+    def _rect(self, layer, x, y, width, height):
+        self.layer(layer).path.append(
+            (int(x), int(y), int(width), int(height)))
+
+    def _cfill(self, mask, layer, r, g, b, a):
+        layer = self.layer(layer)
+        rects, layer.path = layer.path, []
+        if not rects:
+            return
+
+        mask, color = int(mask), (int(r), int(g), int(b), int(a))
+
+        # bounding rect, only fully replaced if path is a single rect
+        x = min(rect[0] for rect in rects)
+        y = min(rect[1] for rect in rects)
+        width = max(rect[0] + rect[2] for rect in rects) - x
+        height = max(rect[1] + rect[3] for rect in rects) - y
+        replaces = len(rects) == 1 and (mask == MASK_SRC or color[3] == 0xFF)
+
+        layer.queue('fill', (x, y, width, height), replaces, mask, rects,
+                    color)
+
+    def _dispose(self, layer):
+        self.layers.pop(int(layer), None)
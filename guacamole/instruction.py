@@ -23,9 +23,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import itertools
-import six
-
-from builtins import str as __unicode__
+import sys
 
 from guacamole.exceptions import InvalidInstruction
 
@@ -37,18 +35,54 @@ ELEM_SEP = '.'  # instruction arg element separator character (e.g. 4.size)
 # @TODO: enumerate instruction set
 
 
-def utf8(unicode_str):
-    """
-    Return a utf-8 encoded string from a valid unicode string.
+if sys.version_info[0] >= 3:
+    def utf8(unicode_str):
+        """
+        Return a utf-8 encoded string from a valid unicode string.
+
+        Python 3 str is unicode already, and is returned as-is.
+
+        :param unicode_str: Unicode string.
+
+        :return: str
+        """
+        return unicode_str
+else:  # pragma: no cover
+    def utf8(unicode_str):
+        """
+        Return a utf-8 encoded string from a valid unicode string.
+
+        :param unicode_str: Unicode string.
+
+        :return: str
+        """
+        if isinstance(unicode_str, unicode):  # noqa: F821
+            return unicode_str.encode('utf-8')
+
+        return unicode_str
 
-    :param unicode_str: Unicode string.
 
-    :return: str
+def _read_arg_size(data, pos):
     """
-    if six.PY2 and isinstance(unicode_str, __unicode__):
-        return unicode_str.encode('utf-8')
+    Read arg length prefix starting at `pos`.
 
-    return unicode_str
+    :return: tuple of (element separator index, arg size)
+    """
+    idx = data.find(ELEM_SEP, pos)
+
+    try:
+        if idx == -1:
+            raise ValueError
+        arg_size = int(data[pos:idx])
+        if arg_size < 0:
+            raise ValueError
+    except Exception:
+        # Expected ValueError
+        raise InvalidInstruction(
+            'Invalid arg length.' +
+            ' Possibly due to missing element separator!')
+
+    return idx, arg_size
 
 
 class GuacamoleInstruction(object):
@@ -94,41 +128,115 @@ class GuacamoleInstruction(object):
         # Use proper encoding
         instruction = utf8(instruction)
 
-        # Get arg size
-        elems = instruction.split(ELEM_SEP, 1)
+        args = []
+        pos = 0
+
+        while True:
+            # Get arg size
+            idx, arg_size = _read_arg_size(instruction, pos)
 
-        try:
-            arg_size = int(elems[0])
-        except Exception:
-            # Expected ValueError
-            raise InvalidInstruction(
-                'Invalid arg length.' +
-                ' Possibly due to missing element separator!')
+            pos = idx + 1 + arg_size
+            arg_str = instruction[idx + 1:pos]
+            args.append(arg_str)
 
-        arg_str = elems[1][:arg_size]
+            sep = instruction[pos:pos + 1]
 
-        remaining = elems[1][arg_size:]
+            if sep == ARG_SEP:
+                # Ignore the ARG_SEP to parse next arg.
+                pos += 1
+            elif sep == INST_TERM and pos + 1 == len(instruction):
+                # This was the last arg!
+                return args
+            else:
+                # The remaining is neither starting with ARG_SEP nor
+                # INST_TERM.
+                raise InvalidInstruction(
+                    'Instruction arg (%s) has invalid length.' % arg_str)
+
+    @staticmethod
+    def peek_opcode(instruction):
+        """
+        Return opcode of encoded instruction without decoding its args.
 
-        args = [arg_str]
+        example:
+        >> opcode = peek_opcode('5.mouse,3.400,3.500,1.0;')
+        >> opcode == 'mouse'
+        >> True
 
-        if remaining.startswith(ARG_SEP):
-            # Ignore the ARG_SEP to parse next arg.
-            remaining = remaining[1:]
-        elif remaining == INST_TERM:
-            # This was the last arg!
-            return args
-        else:
-            # The remaining is neither starting with ARG_SEP nor INST_TERM.
-            raise InvalidInstruction(
-                'Instruction arg (%s) has invalid length.' % arg_str)
+        :param instruction: Instruction string.
 
-        next_args = GuacamoleInstruction.decode_instruction(remaining)
+        :return: str
+        """
+        idx, arg_size = _read_arg_size(instruction, 0)
 
-        if next_args:
-            args = args + next_args
+        return instruction[idx + 1:idx + 1 + arg_size]
+
+    @staticmethod
+    def peek_args(instruction, count):
+        """
+        Return first `count` args (opcode included) of encoded instruction,
+        without decoding the remaining ones. Fewer args are returned if
+        instruction has less than `count` args.
+
+        example:
+        >> args = peek_args('4.blob,1.3,8.AAECAw==;', 2)
+        >> args == ['blob', '3']
+        >> True
+
+        :param instruction: Instruction string.
+
+        :param count: number of args to return.
+
+        :return: list
+        """
+        args = []
+        pos = 0
+
+        while len(args) < count:
+            idx, arg_size = _read_arg_size(instruction, pos)
+
+            pos = idx + 1 + arg_size
+            args.append(instruction[idx + 1:pos])
+
+            if instruction[pos:pos + 1] != ARG_SEP:
+                break
+            pos += 1
 
         return args
 
+    @staticmethod
+    def split_instructions(data):
+        """
+        Split string of one or more encoded instructions, without decoding.
+
+        example:
+        >> list(split_instructions('4.sync,1.1;4.sync,1.2;'))
+        >> ['4.sync,1.1;', '4.sync,1.2;']
+        >> True
+
+        :param data: Instructions string.
+
+        :return: iterator of str
+        """
+        start = pos = 0
+
+        while pos < len(data):
+            idx, arg_size = _read_arg_size(data, pos)
+
+            pos = idx + 1 + arg_size
+            sep = data[pos:pos + 1]
+            pos += 1
+
+            if sep == INST_TERM:
+                yield data[start:pos]
+                start = pos
+            elif sep != ARG_SEP:
+                raise InvalidInstruction(
+                    'Instruction arg has invalid length.')
+
+        if start != len(data):
+            raise InvalidInstruction('Instruction termination not found.')
+
     @staticmethod
     def encode_arg(arg):
         """
@@ -143,9 +251,9 @@ class GuacamoleInstruction(object):
 
         :return: str
         """
-        arg_utf8 = utf8(arg)
+        arg_utf8 = str(utf8(arg))
 
-        return ELEM_SEP.join([str(len(str(arg_utf8))), str(arg_utf8)])
+        return ELEM_SEP.join([str(len(arg_utf8)), arg_utf8])
 
     def encode(self):
         """
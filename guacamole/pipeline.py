@@ -0,0 +1,266 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2014 - 2016 Mohab Usama
+"""
+
+import time
+
+from guacamole.instruction import GuacamoleInstruction as Instruction
+
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class InstructionFilter(object):
+    """
+    Base class of pipeline filters.
+
+    A filter receives decoded instructions it `accepts` (by default, those
+    whose opcode is in `opcodes`, or all instructions if None), and returns
+    a list of instructions to pass on:
+    the same instruction, a modified one, none (dropped) or several
+    (e.g. previously held instructions).
+    """
+
+    opcodes = None
+
+    def accepts(self, opcode, line, instruction):
+        """
+        Return True if instruction must go through this filter.
+
+        Only one of `line` (encoded instruction) or `instruction` (decoded
+        instruction) is given, the other one is None. Unless needed, `line`
+        should not be decoded.
+        """
+        return self.opcodes is None or opcode in self.opcodes
+
+    def __call__(self, instruction):
+        return [instruction]
+
+    def flush(self):
+        """
+        Return held instructions (if any), which must be sent now.
+
+        Called before any instruction not handled by this filter goes
+        through, so the order of instructions is preserved.
+        """
+        return []
+
+    def poll(self):
+        """
+        Return held instructions (if any) which were held long enough.
+        """
+        return []
+
+
+class Pipeline(object):
+    """
+    Chain of InstructionFilter.
+
+    Instructions are dispatched to filters by opcode. Instructions matching
+    no filter are passed on as-is, without being decoded.
+    """
+
+    def __init__(self, *filters):
+        self.filters = list(filters)
+
+    def add(self, instruction_filter):
+        """
+        Append filter to pipeline.
+        """
+        self.filters.append(instruction_filter)
+
+    def process(self, data):
+        """
+        Run encoded instructions through pipeline.
+
+        :param data: string of one or more encoded instructions.
+
+        :return: list of encoded instructions
+        """
+        result = []
+        for line in Instruction.split_instructions(data):
+            result.extend(
+                self._run(0, Instruction.peek_opcode(line), line, None))
+        return result
+
+    def flush(self):
+        """
+        Return instructions held by filters (e.g. coalesced mouse moves).
+
+        :return: list of encoded instructions
+        """
+        return self._release('flush')
+
+    def poll(self):
+        """
+        Return instructions held by filters for long enough (e.g. last
+        mouse move, once coalescing interval elapsed).
+
+        :return: list of encoded instructions
+        """
+        return self._release('poll')
+
+    def _release(self, method):
+        result = []
+        for i, instruction_filter in enumerate(self.filters):
+            for held in getattr(instruction_filter, method)():
+                result.extend(self._run(i + 1, held.opcode, None, held))
+        return result
+
+    def _run(self, start, opcode, line, instruction):
+        result = []
+
+        for i in range(start, len(self.filters)):
+            instruction_filter = self.filters[i]
+
+            if not instruction_filter.accepts(opcode, line, instruction):
+                for held in instruction_filter.flush():
+                    result.extend(self._run(i + 1, held.opcode, None, held))
+                continue
+
+            if instruction is None:
+                instruction = Instruction.load(line)
+
+            for output in instruction_filter(instruction):
+                result.extend(self._run(i + 1, output.opcode, None, output))
+
+            return result
+
+        result.append(line if instruction is None else instruction.encode())
+        return result
+
+
+class DropFilter(InstructionFilter):
+    """
+    Drop all instructions with given opcodes.
+
+    If `streams` is True, the first arg of dropped instructions is a stream
+    index (e.g. `clipboard`, `file`), and the `blob` and `end` instructions
+    of those streams are dropped as well. Other streams are passed on without
+    being decoded.
+    """
+
+    def __init__(self, *opcodes, **kwargs):
+        self.streams = kwargs.get('streams', False)
+        self._dropped = set()
+
+        self.opcodes = frozenset(opcodes)
+        if self.streams:
+            self.opcodes |= frozenset(('blob', 'end'))
+
+    def accepts(self, opcode, line, instruction):
+        if opcode not in self.opcodes:
+            return False
+
+        if opcode in ('blob', 'end') and self.streams:
+            if instruction is not None:
+                args = instruction.args
+            else:
+                args = Instruction.peek_args(line, 2)[1:]
+            return bool(args) and args[0] in self._dropped
+
+        return True
+
+    def __call__(self, instruction):
+        if instruction.opcode in ('blob', 'end') and self.streams:
+            if instruction.opcode == 'end':
+                self._dropped.discard(instruction.args[0])
+            return []
+
+        if self.streams and instruction.args:
+            self._dropped.add(instruction.args[0])
+
+        return []
+
+
+class MouseCoalescer(InstructionFilter):
+    """
+    Coalesce consecutive `mouse` moves.
+
+    At most one move (i.e. `mouse` instruction with unchanged button mask)
+    is passed on per `interval` seconds; the latest move is held meanwhile
+    and released by the next instruction, by `Pipeline.poll` once
+    `interval` elapsed, or by `Pipeline.flush`. Button changes are always
+    passed on immediately.
+    """
+
+    opcodes = frozenset(('mouse',))
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+
+        self._held = None
+        self._mask = None
+        self._last = None
+
+    def __call__(self, instruction):
+        mask = instruction.args[2] if len(instruction.args) > 2 else None
+        now = clock()
+
+        if mask != self._mask:
+            # button press/release
+            result = self.flush()
+            self._mask = mask
+        elif self._last is None or now - self._last >= self.interval:
+            # superseded by current move
+            self._held = None
+            result = []
+        else:
+            self._held = instruction
+            return []
+
+        self._last = now
+        result.append(instruction)
+        return result
+
+    def flush(self):
+        if self._held is None:
+            return []
+
+        held, self._held = self._held, None
+        self._last = clock()
+        return [held]
+
+    def poll(self):
+        if self._held is None or clock() - self._last < self.interval:
+            return []
+        return self.flush()
+
+
+class TokenBucket(InstructionFilter):
+    """
+    Rate limit instructions to `rate` per second, with bursts of up to
+    `burst` instructions. Instructions over the limit are dropped.
+
+    `mouse` instructions changing button mask are never dropped, so limiting
+    `mouse` only thins out moves.
+    """
+
+    def __init__(self, rate, burst=None, opcodes=('mouse',)):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.opcodes = frozenset(opcodes)
+
+        self._tokens = self.burst
+        self._last = clock()
+        self._mask = None
+
+    def __call__(self, instruction):
+        now = clock()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+        if instruction.opcode == 'mouse' and len(instruction.args) > 2:
+            mask, self._mask = self._mask, instruction.args[2]
+            if mask != self._mask:
+                self._tokens = max(self._tokens - 1, 0)
+                return [instruction]
+
+        if self._tokens < 1:
+            return []
+
+        self._tokens -= 1
+        return [instruction]
@@ -0,0 +1,348 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2014 - 2016 Mohab Usama
+"""
+
+import socket
+import threading
+import time
+
+from collections import deque
+
+from guacamole import logger as guac_logger
+
+from guacamole.client import GuacamoleClient
+from guacamole.exceptions import GuacamoleError, InvalidInstruction
+
+from guacamole.instruction import GuacamoleInstruction as Instruction
+
+
+clock = getattr(time, 'monotonic', time.time)
+
+# Errors on which a connection attempt is considered failed.
+CONNECT_ERRORS = (socket.error, GuacamoleError, InvalidInstruction)
+
+# Errors on which sending is considered failed (GuacamoleClient raises
+# GuacamoleError once closed).
+SEND_ERRORS = (socket.error, GuacamoleError)
+
+
+class GuacamoleSession(object):
+    """
+    Guacamole session, reconnecting to guacd whenever connection is lost.
+
+    Connection is considered lost if guacd closes it, if nothing is received
+    for `read_timeout` seconds, or (optionally) if no `sync` is received for
+    `sync_timeout` seconds while other instructions (keep-alive `nop`
+    excluded) keep coming. In the latter case the instruction received last
+    is still returned, and reconnecting happens on next `receive`.
+
+    On failure the handshake is retried with exponential backoff, first
+    rejoining the existing guacd connection (via its connection id) when
+    `resume` is True, then falling back to a new connection. Data sent while
+    disconnected is buffered (up to `buffer_size` sends, oldest dropped) and
+    sent, in order, once the connection is rejoined. It is discarded if a new
+    connection had to be established instead, as it belongs to the lost
+    remote session. Buffered data dropped either way is counted in
+    `dropped`. Sending raises GuacamoleError once the session is closed
+    (or gave up reconnecting).
+
+    Like GuacamoleClient, one thread may receive while another sends.
+    Reconnecting is driven by the receiving side.
+    """
+
+    def __init__(self, host, port, read_timeout=10, sync_timeout=None,
+                 max_retries=5, backoff=0.05, max_backoff=2.0,
+                 buffer_size=256, resume=True, logger=None, **client_kwargs):
+        """
+        :param host: guacd server host.
+
+        :param port: guacd server port.
+
+        :param read_timeout: seconds without receiving anything after which
+            connection is considered lost. guacd sends a keep-alive `nop`
+            every 5 seconds.
+
+        :param sync_timeout: seconds without receiving `sync` (counted from
+            the first other instruction, `nop` excluded) after which
+            connection is considered lost. Disabled if None.
+
+        :param max_retries: connection attempts per reconnect.
+
+        :param backoff: seconds to wait after first failed attempt, doubled
+            after each failed attempt.
+
+        :param max_backoff: max seconds to wait between attempts.
+
+        :param buffer_size: max number of sends buffered while disconnected.
+
+        :param resume: if True, try rejoining existing guacd connection.
+
+        :param client_kwargs: extra GuacamoleClient arguments.
+        """
+        self.host = host
+        self.port = port
+        self.read_timeout = read_timeout
+        self.sync_timeout = sync_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.resume = resume
+
+        self.logger = guac_logger
+        if logger:
+            self.logger = logger
+
+        self.client_kwargs = client_kwargs
+        self.client_kwargs['logger'] = self.logger
+
+        self.client = None
+        self.connection_id = None
+
+        # client used by `send` (None while data must be buffered)
+        self._send_client = None
+
+        # handshake args, reused on reconnect
+        self._handshake = {}
+
+        self._outbox = deque(maxlen=buffer_size)
+        # guards `_outbox` and `_send_client`
+        self._outbox_lock = threading.Lock()
+        self._reconnect_lock = threading.Lock()
+        self._closed = False
+        # time of first instruction received since last `sync` (if any)
+        self._sync_wait = None
+        # client on which `sync` timed out, not to be read anymore
+        self._expired = None
+
+        # Metrics
+        self.reconnects = 0
+        self.dropped = 0
+        self.reconnect_latencies = deque(maxlen=100)
+
+    @property
+    def connected(self):
+        return bool(self.client and self.client.connected)
+
+    @property
+    def reconnect_latency(self):
+        """Latency (seconds) of last reconnect, or None."""
+        if self.reconnect_latencies:
+            return self.reconnect_latencies[-1]
+        return None
+
+    def connect(self, **kwargs):
+        """
+        Establish session. Accepts the same args as
+        GuacamoleClient.handshake.
+        """
+        self._handshake = kwargs
+        self._closed = False
+        self.client, rejoined = self._connect(rejoin=False)
+        self._sync_wait = None
+        self._publish(self.client, rejoined)
+
+    def close(self):
+        """
+        Terminate session (no reconnect).
+        """
+        self._closed = True
+        if self.client:
+            self.client.close()
+
+        with self._outbox_lock:
+            self._send_client = None
+
+    def receive(self):
+        """
+        Receive instruction from guacd, reconnecting if needed. Returns None
+        only once session is closed.
+        """
+        while not self._closed:
+            client = self.client
+            line = None
+
+            if client is not self._expired:
+                try:
+                    line = client.receive()
+                except socket.error as e:
+                    self.logger.warning(
+                        'Failed to receive instruction: %s' % e)
+
+            if line is not None:
+                if self._sync_expired(line):
+                    self._expired = client
+                return line
+
+            if self._closed:
+                break
+
+            self._reconnect(client)
+
+        return None
+
+    def read_instruction(self):
+        """
+        Read and decode instruction.
+        """
+        line = self.receive()
+        if line is None:
+            return None
+        return Instruction.load(line)
+
+    def send(self, data):
+        """
+        Send encoded instructions to guacd, or buffer them while
+        disconnected.
+        """
+        with self._outbox_lock:
+            if self._closed:
+                raise GuacamoleError(
+                    'Cannot send instruction. Session closed.')
+
+            client = self._send_client
+            if client is not None:
+                try:
+                    return client.send(data)
+                except SEND_ERRORS as e:
+                    # connection lost, reconnect is driven by `receive`.
+                    self.logger.warning('Failed to send instruction: %s' % e)
+                    self._send_client = None
+
+            # invalid data must fail now, not once connection is back.
+            for _ in Instruction.split_instructions(data):
+                pass
+
+            self._buffer(data)
+
+    def send_instruction(self, instruction):
+        """
+        Send instruction after encoding.
+        """
+        return self.send(instruction.encode())
+
+    def _buffer(self, data):
+        # `_outbox_lock` must be held.
+        if len(self._outbox) == self._outbox.maxlen:
+            self.dropped += 1
+        self._outbox.append(data)
+
+    def _sync_expired(self, line):
+        if self.sync_timeout is None:
+            return False
+
+        opcode = Instruction.peek_opcode(line)
+        if opcode == 'sync':
+            self._sync_wait = None
+            return False
+
+        if opcode == 'nop':
+            # keep-alive, sent even if remote desktop is idle
+            return False
+
+        now = clock()
+        if self._sync_wait is None:
+            self._sync_wait = now
+            return False
+
+        if now - self._sync_wait > self.sync_timeout:
+            self.logger.warning('No `sync` received for %s seconds.'
+                                % (now - self._sync_wait))
+            return True
+
+        return False
+
+    def _new_client(self):
+        return GuacamoleClient(self.host, self.port, self.read_timeout,
+                               **self.client_kwargs)
+
+    def _connect(self, rejoin):
+        if rejoin:
+            client = self._new_client()
+            try:
+                client.handshake(
+                    **dict(self._handshake, connectionid=self.connection_id))
+                self.logger.info('Rejoined connection %s'
+                                 % self.connection_id)
+                return client, True
+            except CONNECT_ERRORS as e:
+                self.logger.warning('Failed to rejoin connection %s: %s'
+                                    % (self.connection_id, e))
+                client.close()
+
+        client = self._new_client()
+        try:
+            client.handshake(**self._handshake)
+        except CONNECT_ERRORS:
+            client.close()
+            raise
+
+        self.connection_id = client.id
+        return client, False
+
+    def _publish(self, client, rejoined):
+        """
+        Send buffered data through `client` (if `rejoined`), then let `send`
+        use it.
+        """
+        with self._outbox_lock:
+            if not rejoined and self._outbox:
+                self.logger.warning(
+                    'Discarding %s buffered sends of previous connection.'
+                    % len(self._outbox))
+                self.dropped += len(self._outbox)
+                self._outbox.clear()
+
+            while self._outbox:
+                data = self._outbox.popleft()
+                try:
+                    client.send(data)
+                except SEND_ERRORS as e:
+                    # lost again, keep buffering until next reconnect.
+                    self.logger.warning(
+                        'Failed to send buffered instruction: %s' % e)
+                    self._outbox.appendleft(data)
+                    return
+
+            self._send_client = client
+
+    def _reconnect(self, failed):
+        with self._reconnect_lock:
+            if failed is not self.client or self._closed:
+                # already reconnected (or closed) meanwhile
+                return
+
+            start = clock()
+
+            # wakes up any `send` blocked on failed connection
+            failed.close()
+            with self._outbox_lock:
+                self._send_client = None
+
+            delay = self.backoff
+            rejoin = self.resume and self.connection_id is not None
+
+            for attempt in range(1, self.max_retries + 1):
+                try:
+                    client, rejoined = self._connect(rejoin)
+                    break
+                except CONNECT_ERRORS as e:
+                    self.logger.warning('Reconnect attempt %s failed: %s'
+                                        % (attempt, e))
+                    if attempt < self.max_retries:
+                        time.sleep(delay)
+                        delay = min(delay * 2, self.max_backoff)
+            else:
+                self._closed = True
+                raise GuacamoleError(
+                    'Cannot reconnect after %s attempts.' % self.max_retries)
+
+            self.client = client
+            self._sync_wait = None
+            self._publish(client, rejoined)
+
+            latency = clock() - start
+            self.reconnects += 1
+            self.reconnect_latencies.append(latency)
+            self.logger.info('Reconnected in %.3f seconds.' % latency)
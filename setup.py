@@ -5,10 +5,11 @@ from setuptools import setup, find_packages
 from guacamole import VERSION
 
 
-install_requires = (
-    'future >= 0.15.2',
-    'six >= 1.10.0'
-)
+install_requires = ()
+
+extras_require = {
+    'display': ['Pillow'],
+}
 
 
 setup(
@@ -22,6 +23,7 @@ setup(
     zip_safe=False,
     packages=find_packages(exclude=['tests']),
     install_requires=install_requires,
+    extras_require=extras_require,
     tests_require=['nose', 'mock'],
     test_suite='nose.collector',
     classifiers=[
@@ -1,8 +1,16 @@
 from .test import GuacamoleClientTest
+from .test import GuacamoleClientConcurrencyTest
 from .test import GuacamoleInstructionTest
+from .test import PipelineTest
+from .test import GuacamoleSessionTest
+from .test import GuacamoleDisplayTest
 
 
 __all__ = [
     GuacamoleClientTest,
+    GuacamoleClientConcurrencyTest,
     GuacamoleInstructionTest,
+    PipelineTest,
+    GuacamoleSessionTest,
+    GuacamoleDisplayTest,
 ]
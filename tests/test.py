@@ -6,20 +6,36 @@ The MIT License (MIT)
 Copyright (c) 2014 - 2016 Mohab Usama
 """
 
+import base64
+import io
 import six
-
-from mock import MagicMock
-from unittest import TestCase
-
-from guacamole.client import GuacamoleClient
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from mock import MagicMock, patch
+from unittest import TestCase, skipIf
+
+from guacamole.cache import HandshakeCache
+from guacamole.client import BUF_LEN, GuacamoleClient
+from guacamole.display import GuacamoleDisplay, Image
 from guacamole.exceptions import GuacamoleError, InvalidInstruction
 from guacamole.instruction import GuacamoleInstruction as Instruction
+from guacamole.pipeline import (
+    Pipeline, DropFilter, MouseCoalescer, TokenBucket)
+from guacamole.session import GuacamoleSession
 
 
 class GuacamoleClientTest(TestCase):
 
     def setUp(self):
         self.client = GuacamoleClient('127.0.0.1', 4822)
+        # handshake opens connection
+        patcher = patch('socket.create_connection')
+        patcher.start()
+        self.addCleanup(patcher.stop)
         # patch `send`
         self.client.send = MagicMock()
         self.client.close = MagicMock()
@@ -139,6 +155,239 @@ class GuacamoleClientTest(TestCase):
         with self.assertRaises(InvalidInstruction):
             self.client.handshake(protocol='rdp')
 
+    def test_handshake_connection_lost(self):
+        """
+        Test connection lost during handshake.
+        """
+        self.client.send_instruction = MagicMock()
+        self.client.receive = MagicMock(side_effect=[
+            '4.args,8.hostname;', None])
+
+        with self.assertRaises(GuacamoleError):
+            self.client.handshake(protocol='rdp')
+
+        self.assertFalse(self.client.connected)
+        self.assertTrue(self.client.close.called)
+
+    def test_handshake_args_cache(self):
+        """
+        Test handshake populates `args` cache, then uses it speculatively.
+        """
+        args = '4.args,13.VERSION_1_1_0,8.hostname,4.port;'
+        ready = '5.ready,5.$1234;'
+
+        self.client.args_cache = HandshakeCache()
+        self.client.send_instruction = MagicMock()
+        self.client.receive = MagicMock(side_effect=[args, ready])
+
+        self.client.handshake(protocol='rdp', hostname='h', port=3389)
+
+        key = HandshakeCache.key('127.0.0.1', 4822, 'rdp')
+        cached = self.client.args_cache.get(key)
+        self.assertEqual(('VERSION_1_1_0', 'hostname', 'port'), cached)
+        self.assertEqual('VERSION_1_1_0', HandshakeCache.version(cached))
+
+        # second handshake sends `connect` before reading `args`
+        sent = []
+        received = []
+
+        def mock_receive():
+            received.append([i.opcode for i in sent])
+            return [args, ready][len(received) - 1]
+
+        self.client.send_instruction = MagicMock(side_effect=sent.append)
+        self.client.receive = MagicMock(side_effect=mock_receive)
+
+        self.client.handshake(protocol='rdp', hostname='h', port=3389)
+
+        self.assertEqual(
+            ['select', 'size', 'audio', 'video', 'image', 'connect'],
+            received[0])
+        self.assertEqual(('', 'h', 3389), sent[5].args)
+        self.assertTrue(self.client.connected)
+
+    def test_handshake_args_cache_mismatch(self):
+        """
+        Test stale cached `args` falls back to a regular handshake.
+        """
+        key = HandshakeCache.key('127.0.0.1', 4822, 'rdp')
+        self.client.args_cache = HandshakeCache()
+        self.client.args_cache.set(key, ['VERSION_1_0_0', 'hostname'])
+
+        args = '4.args,13.VERSION_1_1_0,8.hostname,4.port;'
+        ready = '5.ready,5.$1234;'
+
+        self.client.send_instruction = MagicMock()
+        self.client.receive = MagicMock(side_effect=[args, args, ready])
+
+        self.client.logger = MagicMock()
+        self.client.handshake(protocol='rdp')
+
+        warning = self.client.logger.warning.call_args[0][0]
+        self.assertIn('guacd version VERSION_1_1_0 (cached VERSION_1_0_0)',
+                      warning)
+
+        opcodes = [c[0][0].opcode
+                   for c in self.client.send_instruction.call_args_list]
+        self.assertEqual(['select', 'size', 'audio', 'video', 'image',
+                          'connect'] * 2, opcodes)
+        self.assertEqual(1, self.client.close.call_count)
+        self.assertEqual(('VERSION_1_1_0', 'hostname', 'port'),
+                         self.client.args_cache.get(key))
+        self.assertTrue(self.client.connected)
+
+    def test_handshake_args_cache_mismatch_override(self):
+        """
+        Test stale cached `args` retry keeps display size overrides.
+        """
+        key = HandshakeCache.key('127.0.0.1', 4822, 'rdp')
+        self.client.args_cache = HandshakeCache()
+        self.client.args_cache.set(key, ['VERSION_1_0_0', 'width'])
+
+        args = '4.args,13.VERSION_1_1_0,5.width,6.height,3.dpi;'
+        ready = '5.ready,5.$1234;'
+
+        self.client.send_instruction = MagicMock()
+        self.client.receive = MagicMock(side_effect=[args, args, ready])
+
+        self.client.handshake(protocol='rdp', width_override=1280,
+                              height_override=720, dpi_override=120)
+
+        connect = [c[0][0] for c in self.client.send_instruction.call_args_list
+                   if c[0][0].opcode == 'connect']
+        self.assertEqual(2, len(connect))
+        self.assertEqual(('', 1280, 720, 120), connect[1].args)
+        self.assertTrue(self.client.connected)
+
+
+class GuacamoleClientConcurrencyTest(TestCase):
+
+    def setUp(self):
+        self.client = GuacamoleClient('127.0.0.1', 4822)
+        self.client._client, self.guacd = socket.socketpair()
+
+    def tearDown(self):
+        self.client.close()
+        self.guacd.close()
+
+    def test_close_wakes_reader(self):
+        """
+        Test close from another thread unblocks a pending receive.
+        """
+        result = []
+
+        reader = threading.Thread(
+            target=lambda: result.append(self.client.receive()))
+        reader.start()
+
+        time.sleep(0.1)
+        self.client.close()
+        reader.join(2)
+
+        self.assertFalse(reader.is_alive())
+        self.assertEqual([None], result)
+        self.assertIsNone(self.client._client)
+
+    def test_send_while_reading(self):
+        """
+        Test send is not blocked by a pending receive.
+        """
+        result = []
+
+        reader = threading.Thread(
+            target=lambda: result.append(self.client.read_instruction()))
+        reader.start()
+        time.sleep(0.1)
+
+        self.client.send_instruction(Instruction('mouse', 1, 2))
+        self.assertEqual(b'5.mouse,1.1,1.2;', self.guacd.recv(1024))
+
+        self.guacd.sendall(b'4.sync,4.1234;')
+        reader.join(2)
+
+        self.assertEqual('sync', result[0].opcode)
+        self.assertEqual(('1234',), result[0].args)
+
+    def test_connect_once(self):
+        """
+        Test concurrent access to `client` opens a single connection.
+        """
+        self.client.close()
+
+        def slow_connect(*args):
+            time.sleep(0.1)
+            return MagicMock()
+
+        with patch('socket.create_connection',
+                   MagicMock(side_effect=slow_connect)) as create:
+            threads = [threading.Thread(target=lambda: self.client.client)
+                       for _ in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(1, create.call_count)
+
+    def test_io_after_close(self):
+        """
+        Test reads and writes after close do not open a new connection.
+        """
+        self.client.close()
+
+        with patch('socket.create_connection') as create:
+            self.assertIsNone(self.client.receive())
+            with self.assertRaises(GuacamoleError):
+                self.client.send('5.mouse,1.1,1.2;')
+
+        self.assertFalse(create.called)
+
+    def test_close_while_sending(self):
+        """
+        Test writer thread racing close never reconnects.
+        """
+        errors = []
+
+        def writer():
+            try:
+                while True:
+                    self.client.send_instruction(Instruction('mouse', 1, 2))
+            except GuacamoleError as e:
+                errors.append(e)
+
+        def drain():
+            # keep guacd end reading so `sendall` does not block
+            while self.guacd.recv(BUF_LEN):
+                pass
+
+        drain_thread = threading.Thread(target=drain)
+        drain_thread.start()
+
+        with patch('socket.create_connection') as create:
+            thread = threading.Thread(target=writer)
+            thread.start()
+            time.sleep(0.05)
+            self.client.close()
+            thread.join(2)
+
+        self.guacd.shutdown(socket.SHUT_RDWR)
+        drain_thread.join(2)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(1, len(errors))
+        self.assertFalse(create.called)
+
+    def test_close_idempotent(self):
+        """
+        Test close without connection does not connect.
+        """
+        self.client.close()
+
+        with patch('socket.create_connection') as create:
+            self.client.close()
+
+        self.assertFalse(create.called)
+
 
 class GuacamoleInstructionTest(TestCase):
 
@@ -283,6 +532,15 @@ class GuacamoleInstructionTest(TestCase):
         with self.assertRaises(InvalidInstruction):
             Instruction.load(instruction_str)
 
+    def test_instruction_invalid_arg_length_negative(self):
+        """
+        Instruction with negative arg length.
+        """
+        instruction_str = '1.a,-4.x;'
+
+        with self.assertRaises(InvalidInstruction):
+            Instruction.load(instruction_str)
+
     def test_instruction_invalid_element_separator(self):
         """
         Instruction with invalid element separator.
@@ -300,3 +558,706 @@ class GuacamoleInstructionTest(TestCase):
 
         with self.assertRaises(InvalidInstruction):
             Instruction.load(instruction_str)
+
+    def test_instruction_import_no_compat(self):
+        """
+        Test instruction module does not load compatibility packages.
+        """
+        if six.PY2:
+            self.skipTest('Python 3 only')
+
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, guacamole.instruction; '
+            'print(sorted({"six", "future"} & set(sys.modules)))'
+        ])
+
+        self.assertEqual(b"[]", output.strip())
+
+    def test_instruction_peek_opcode(self):
+        """
+        Test opcode peeking.
+        """
+        self.assertEqual(
+            'mouse', Instruction.peek_opcode('5.mouse,3.400,3.500,1.0;'))
+        self.assertEqual('sync', Instruction.peek_opcode('4.sync;'))
+
+        with self.assertRaises(InvalidInstruction):
+            Instruction.peek_opcode('mouse,3.400;')
+
+        with self.assertRaises(InvalidInstruction):
+            Instruction.peek_opcode('5;')
+
+    def test_split_instructions(self):
+        """
+        Test splitting multiple instructions.
+        """
+        data = '4.sync,1.1;4.args,6.p,.; t;5.mouse,1.1,1.2,1.0;'
+
+        self.assertEqual(
+            ['4.sync,1.1;', '4.args,6.p,.; t;', '5.mouse,1.1,1.2,1.0;'],
+            list(Instruction.split_instructions(data)))
+
+        with self.assertRaises(InvalidInstruction):
+            list(Instruction.split_instructions('4.sync,1.1'))
+
+        with self.assertRaises(InvalidInstruction):
+            list(Instruction.split_instructions('4.sync,2.1;'))
+
+    def test_split_instructions_invalid_arg_length(self):
+        """
+        Test splitting rejects missing element separator and negative length.
+        """
+        with self.assertRaises(InvalidInstruction):
+            list(Instruction.split_instructions('4.sync,1;'))
+
+        with self.assertRaises(InvalidInstruction):
+            list(Instruction.split_instructions('5.mouse,1.1,-4.2;'))
+
+    def test_instruction_peek_args(self):
+        """
+        Test peeking first args.
+        """
+        self.assertEqual(
+            ['blob', '3'],
+            Instruction.peek_args('4.blob,1.3,8.AAECAw==;', 2))
+        self.assertEqual(['sync'], Instruction.peek_args('4.sync;', 2))
+
+        with self.assertRaises(InvalidInstruction):
+            Instruction.peek_args('4.blob,-1.3;', 2)
+
+
+class PipelineTest(TestCase):
+
+    def mouse(self, x, y, mask=0):
+        return Instruction('mouse', x, y, mask).encode()
+
+    def test_pass_through(self):
+        """
+        Test unrelated instructions are not decoded.
+        """
+        pipeline = Pipeline(DropFilter('clipboard'))
+        data = '3.key,5.65307,1.1;4.sync,1.1;'
+
+        with patch.object(Instruction, 'load') as load:
+            self.assertEqual(['3.key,5.65307,1.1;', '4.sync,1.1;'],
+                             pipeline.process(data))
+
+        self.assertFalse(load.called)
+
+    def test_pass_through_streams(self):
+        """
+        Test blobs of streams which are not dropped are not decoded.
+        """
+        pipeline = Pipeline(DropFilter('clipboard', streams=True))
+        data = '4.blob,1.4,8.aGVsbG8=;3.end,1.4;'
+
+        with patch.object(Instruction, 'load') as load:
+            self.assertEqual(['4.blob,1.4,8.aGVsbG8=;', '3.end,1.4;'],
+                             pipeline.process(data))
+
+        self.assertFalse(load.called)
+
+    def test_drop_stream(self):
+        """
+        Test dropping clipboard stream, including its blobs.
+        """
+        pipeline = Pipeline(DropFilter('clipboard', streams=True))
+        data = ''.join(i.encode() for i in [
+            Instruction('clipboard', 3, 'text/plain'),
+            Instruction('blob', 3, 'aGVsbG8='),
+            Instruction('blob', 4, 'aGVsbG8='),
+            Instruction('end', 3),
+            Instruction('end', 4),
+        ])
+
+        self.assertEqual(['4.blob,1.4,8.aGVsbG8=;', '3.end,1.4;'],
+                         pipeline.process(data))
+
+    def test_mouse_coalescer(self):
+        """
+        Test mouse moves are coalesced, preserving order and buttons.
+        """
+        pipeline = Pipeline(MouseCoalescer(interval=60))
+
+        self.assertEqual([self.mouse(1, 1)],
+                         pipeline.process(self.mouse(1, 1)))
+        self.assertEqual([], pipeline.process(self.mouse(2, 2)))
+        self.assertEqual([], pipeline.process(self.mouse(3, 3)))
+
+        # held move is sent before other instructions
+        self.assertEqual([self.mouse(3, 3), '4.sync,1.1;'],
+                         pipeline.process('4.sync,1.1;'))
+
+        self.assertEqual([], pipeline.process(self.mouse(4, 4)))
+
+        # button press is never delayed
+        self.assertEqual([self.mouse(4, 4), self.mouse(5, 5, 1)],
+                         pipeline.process(self.mouse(5, 5, 1)))
+
+        self.assertEqual([], pipeline.process(self.mouse(6, 6, 1)))
+        self.assertEqual([self.mouse(6, 6, 1)], pipeline.flush())
+        self.assertEqual([], pipeline.flush())
+
+    def test_token_bucket(self):
+        """
+        Test rate limiting drops moves over the limit only.
+        """
+        pipeline = Pipeline(TokenBucket(rate=0.001, burst=2))
+
+        self.assertEqual(2, len(pipeline.process(
+            self.mouse(1, 1) + self.mouse(2, 2) + self.mouse(3, 3))))
+
+        self.assertEqual([self.mouse(4, 4, 1), '4.sync,1.1;'],
+                         pipeline.process(self.mouse(4, 4, 1) + '4.sync,1.1;'))
+        self.assertEqual([], pipeline.process(self.mouse(5, 5, 1)))
+
+    def test_client_pipelines(self):
+        """
+        Test client runs send and receive pipelines.
+        """
+        client = GuacamoleClient(
+            '127.0.0.1', 4822,
+            send_pipeline=Pipeline(DropFilter('clipboard'),
+                                   MouseCoalescer(interval=60)),
+            receive_pipeline=Pipeline(DropFilter('clipboard', streams=True)))
+        client._client, guacd = socket.socketpair()
+
+        client.send(self.mouse(1, 1) + self.mouse(2, 2))
+        client.send('9.clipboard,1.1,10.text/plain;')
+        client.flush()
+        self.assertEqual(
+            (self.mouse(1, 1) + self.mouse(2, 2)).encode(), guacd.recv(1024))
+
+        guacd.sendall(b'9.clipboard,1.1,10.text/plain;3.end,1.1;'
+                      b'4.sync,1.1;4.sync,1.2;')
+        self.assertEqual('4.sync,1.1;', client.receive())
+        self.assertEqual('4.sync,1.2;', client.receive())
+
+        client.close()
+        guacd.close()
+
+    def test_client_release_held_on_receive(self):
+        """
+        Test held mouse move is sent on receive once interval elapsed.
+        """
+        client = GuacamoleClient(
+            '127.0.0.1', 4822,
+            send_pipeline=Pipeline(MouseCoalescer(interval=0.05)))
+        client._client, guacd = socket.socketpair()
+
+        client.send(self.mouse(1, 1) + self.mouse(2, 2))
+        self.assertEqual(self.mouse(1, 1).encode(), guacd.recv(1024))
+
+        guacd.sendall(b'4.sync,1.1;4.sync,1.2;')
+
+        # not due yet
+        client.receive()
+        guacd.setblocking(False)
+        with self.assertRaises(socket.error):
+            guacd.recv(1024)
+
+        time.sleep(0.06)
+        client.receive()
+        self.assertEqual(self.mouse(2, 2).encode(), guacd.recv(1024))
+
+        client.close()
+        guacd.close()
+
+    def test_client_received_reset(self):
+        """
+        Test filtered instructions of a previous connection are dropped.
+        """
+        client = GuacamoleClient(
+            '127.0.0.1', 4822, receive_pipeline=Pipeline())
+        client._client, guacd = socket.socketpair()
+
+        guacd.sendall(b'4.sync,1.1;')
+        self.assertEqual('4.sync,1.1;', client.receive())
+        client._received.append('4.sync,5.stale;')
+
+        client.close()
+        guacd.close()
+        self.assertIsNone(client.receive())
+
+        client._client, guacd = socket.socketpair()
+        guacd.sendall(b'4.sync,1.2;')
+        self.assertEqual('4.sync,1.2;', client.receive())
+
+        client.close()
+        guacd.close()
+
+
+class GuacamoleSessionTest(TestCase):
+
+    def setUp(self):
+        self.clients = []
+
+        patcher = patch('guacamole.session.GuacamoleClient',
+                        MagicMock(side_effect=self.new_client))
+        self.client_class = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.session = GuacamoleSession(
+            '127.0.0.1', 4822, backoff=0.001, max_retries=3)
+
+    def new_client(self, *args, **kwargs):
+        """
+        Return next mocked GuacamoleClient.
+        """
+        client = self.clients.pop(0)
+        client.connected = True
+        client.close = MagicMock(
+            side_effect=lambda: setattr(client, 'connected', False))
+        return client
+
+    def mock_client(self, received=(), handshake=None):
+        client = MagicMock()
+        client.id = '$1234'
+        client.receive = MagicMock(side_effect=list(received))
+        client.handshake = MagicMock(side_effect=handshake)
+        self.clients.append(client)
+        return client
+
+    def test_rejoin(self):
+        """
+        Test lost connection is rejoined via connection id.
+        """
+        first = self.mock_client(['4.sync,1.1;', None])
+        second = self.mock_client(['4.sync,1.2;'])
+
+        self.session.connect(protocol='rdp', hostname='localhost')
+
+        self.assertEqual('4.sync,1.1;', self.session.receive())
+        self.assertEqual('4.sync,1.2;', self.session.receive())
+
+        first.handshake.assert_called_once_with(
+            protocol='rdp', hostname='localhost')
+        second.handshake.assert_called_once_with(
+            connectionid='$1234', protocol='rdp', hostname='localhost')
+
+        self.assertIs(second, self.session.client)
+        self.assertEqual(1, self.session.reconnects)
+        self.assertIsNotNone(self.session.reconnect_latency)
+
+    def test_rejoin_failure(self):
+        """
+        Test new connection is established if rejoining fails.
+        """
+        self.mock_client([socket.timeout()])
+        rejoin = self.mock_client(handshake=GuacamoleError('Lost'))
+        new = self.mock_client(['4.sync,1.2;'])
+
+        self.session.connect(protocol='rdp')
+
+        self.assertEqual('4.sync,1.2;', self.session.receive())
+
+        self.assertTrue(rejoin.close.called)
+        new.handshake.assert_called_once_with(protocol='rdp')
+        self.assertIs(new, self.session.client)
+
+    def test_reconnect_failure(self):
+        """
+        Test session gives up after max retries.
+        """
+        self.mock_client([None])
+        for _ in range(3):
+            self.mock_client(handshake=socket.error('Refused'))
+
+        self.session.resume = False
+        self.session.connect(protocol='rdp')
+
+        with self.assertRaises(GuacamoleError):
+            self.session.receive()
+
+        self.assertIsNone(self.session.receive())
+        self.assertEqual(4, self.client_class.call_count)
+
+        with self.assertRaises(GuacamoleError):
+            self.session.send('1.a;')
+
+    def test_send_buffered(self):
+        """
+        Test sends are buffered while disconnected and bounded.
+        """
+        self.session = GuacamoleSession('127.0.0.1', 4822, buffer_size=2)
+
+        first = self.mock_client([None])
+        second = self.mock_client(['4.sync,1.2;'])
+
+        self.session.connect(protocol='rdp')
+
+        first.send = MagicMock(side_effect=socket.error('Broken pipe'))
+        self.session.send('1.a;')
+        first.connected = False
+        self.session.send('1.b;')
+        self.session.send('1.c;')
+
+        self.assertEqual(1, self.session.dropped)
+
+        self.session.receive()
+
+        self.assertEqual(['1.b;', '1.c;'],
+                         [c[0][0] for c in second.send.call_args_list])
+
+    def test_send_closed_client(self):
+        """
+        Test send racing a closed client is buffered and resent in order.
+        """
+        first = self.mock_client([None])
+        second = self.mock_client(['4.sync,1.2;'])
+
+        self.session.connect(protocol='rdp')
+
+        first.send = MagicMock(side_effect=GuacamoleError('Closed'))
+        self.session.send('1.a;')
+        self.session.send('1.b;')
+
+        # no further attempt on failed client
+        self.assertEqual(1, first.send.call_count)
+
+        self.session.receive()
+
+        self.assertEqual(['1.a;', '1.b;'],
+                         [c[0][0] for c in second.send.call_args_list])
+
+    def test_send_discarded_on_new_connection(self):
+        """
+        Test buffered data is not replayed into a new connection.
+        """
+        first = self.mock_client([None])
+        self.mock_client(handshake=GuacamoleError('Lost'))
+        new = self.mock_client(['4.sync,1.2;'])
+
+        self.session.connect(protocol='rdp')
+
+        first.send = MagicMock(side_effect=socket.error('Broken pipe'))
+        self.session.send('1.a;')
+        self.session.send('1.b;')
+
+        self.session.receive()
+
+        self.assertFalse(new.send.called)
+        self.assertEqual(2, self.session.dropped)
+
+        self.session.send('1.c;')
+        new.send.assert_called_once_with('1.c;')
+
+    def test_send_order_while_draining(self):
+        """
+        Test concurrent send waits until buffered data is sent.
+        """
+        first = self.mock_client([None])
+        second = self.mock_client(['4.sync,1.2;'])
+
+        self.session.connect(protocol='rdp')
+
+        first.send = MagicMock(side_effect=socket.error('Broken pipe'))
+        self.session.send('1.a;')
+        self.session.send('1.b;')
+
+        sent = []
+        writers = []
+
+        def mock_send(data):
+            if not writers:
+                writers.append(threading.Thread(
+                    target=self.session.send, args=('1.z;',)))
+                writers[0].start()
+                time.sleep(0.05)
+            sent.append(data)
+
+        second.send = MagicMock(side_effect=mock_send)
+
+        self.session.receive()
+        writers[0].join(2)
+
+        self.assertEqual(['1.a;', '1.b;', '1.z;'], sent)
+
+    def test_sync_timeout(self):
+        """
+        Test missing `sync` is detected as lost connection, without losing
+        the instruction received last.
+        """
+        self.session.sync_timeout = 0
+
+        first = self.mock_client(
+            ['4.sync,1.1;', '4.size,1.0,2.10,2.10;', '4.size,1.0,2.20,2.20;'])
+        second = self.mock_client(['4.sync,1.2;'])
+
+        self.session.connect(protocol='rdp')
+
+        self.assertEqual('4.sync,1.1;', self.session.receive())
+        self.assertEqual('4.size,1.0,2.10,2.10;', self.session.receive())
+        time.sleep(0.01)
+        self.assertEqual('4.size,1.0,2.20,2.20;', self.session.receive())
+        self.assertIs(first, self.session.client)
+
+        self.assertEqual('4.sync,1.2;', self.session.receive())
+        self.assertIs(second, self.session.client)
+        self.assertEqual(3, first.receive.call_count)
+
+    def test_sync_timeout_idle(self):
+        """
+        Test keep-alive `nop` of idle connection does not trip sync timeout.
+        """
+        self.session.sync_timeout = 0
+
+        first = self.mock_client(['4.sync,1.1;', '3.nop;', '3.nop;'])
+
+        self.session.connect(protocol='rdp')
+
+        self.assertEqual('4.sync,1.1;', self.session.receive())
+        time.sleep(0.01)
+        self.assertEqual('3.nop;', self.session.receive())
+        time.sleep(0.01)
+        self.assertEqual('3.nop;', self.session.receive())
+
+        self.assertIs(first, self.session.client)
+        self.assertEqual(0, self.session.reconnects)
+
+    def test_rejoin_connection_id(self):
+        """
+        Test rejoining connection joined via connection id.
+        """
+        self.mock_client([None])
+        second = self.mock_client(['4.sync,1.2;'])
+
+        self.session.connect(connectionid='$1234')
+        self.assertEqual('4.sync,1.2;', self.session.receive())
+
+        second.handshake.assert_called_once_with(connectionid='$1234')
+
+    def test_send_invalid(self):
+        """
+        Test invalid data raises and does not stop sending.
+        """
+        first = self.mock_client()
+
+        self.session.connect(protocol='rdp')
+
+        first.send = MagicMock(side_effect=InvalidInstruction('Bad'))
+        with self.assertRaises(InvalidInstruction):
+            self.session.send('1.a')
+
+        first.send = MagicMock()
+        self.session.send('1.b;')
+        first.send.assert_called_once_with('1.b;')
+
+        # also while disconnected
+        self.session._send_client = None
+        with self.assertRaises(InvalidInstruction):
+            self.session.send('1.a')
+        self.assertEqual(0, len(self.session._outbox))
+
+    def test_send_closed(self):
+        """
+        Test sending on closed session raises.
+        """
+        self.mock_client()
+
+        self.session.connect(protocol='rdp')
+        self.session.close()
+
+        with self.assertRaises(GuacamoleError):
+            self.session.send('1.a;')
+
+    def test_close(self):
+        """
+        Test closed session does not reconnect.
+        """
+        first = self.mock_client([None])
+
+        self.session.connect(protocol='rdp')
+        self.session.close()
+
+        self.assertIsNone(self.session.receive())
+        self.assertTrue(first.close.called)
+        self.assertEqual(1, self.client_class.call_count)
+
+
+@skipIf(Image is None, 'Pillow is not installed')
+class GuacamoleDisplayTest(TestCase):
+
+    def setUp(self):
+        self.display = GuacamoleDisplay()
+        self.apply('size', 0, 64, 32)
+
+    def apply(self, *args):
+        self.display.apply(Instruction(*args))
+
+    def fill(self, layer, x, y, width, height, color, mask=0xC):
+        self.apply('rect', layer, x, y, width, height)
+        self.apply('cfill', mask, layer, *color)
+
+    def test_size(self):
+        """
+        Test layer size.
+        """
+        self.assertEqual((64, 32), (self.display.width, self.display.height))
+        self.assertEqual((64, 32), self.display.screenshot().size)
+
+    def test_rect_cfill(self):
+        """
+        Test rect filling, with and without alpha.
+        """
+        self.fill(0, 0, 0, 10, 10, (255, 0, 0, 255))
+        self.fill(0, 5, 5, 10, 10, (0, 0, 255, 128), mask=0xE)
+
+        image = self.display.screenshot()
+        self.assertEqual((255, 0, 0, 255), image.getpixel((0, 0)))
+        self.assertEqual((0, 0, 255, 128), image.getpixel((12, 12)))
+        self.assertEqual((0, 0, 0, 0), image.getpixel((20, 20)))
+
+        r, g, b, a = image.getpixel((6, 6))
+        self.assertEqual(255, a)
+        self.assertTrue(r > 100 and b > 100)
+
+    def test_img(self):
+        """
+        Test image stream drawn on `end`.
+        """
+        data = io.BytesIO()
+        Image.new('RGBA', (4, 4), (1, 2, 3, 255)).save(data, 'PNG')
+        data = base64.b64encode(data.getvalue()).decode()
+
+        self.apply('img', 1, 0xC, 0, 'image/png', 8, 8)
+        self.apply('blob', 1, data[:8])
+        self.apply('blob', 1, data[8:])
+
+        # not drawn until stream ends
+        self.assertEqual((0, 0, 0, 0),
+                         self.display.screenshot().getpixel((8, 8)))
+
+        self.apply('end', 1)
+
+        image = self.display.screenshot()
+        self.assertEqual((1, 2, 3, 255), image.getpixel((8, 8)))
+        self.assertEqual((1, 2, 3, 255), image.getpixel((11, 11)))
+        self.assertEqual((0, 0, 0, 0), image.getpixel((12, 12)))
+
+    def test_copy_from_buffer(self):
+        """
+        Test copy from (autosized) buffer to default layer.
+        """
+        self.fill(-1, 0, 0, 4, 4, (9, 9, 9, 255))
+        self.apply('copy', -1, 0, 0, 4, 4, 0xE, 0, 30, 10)
+
+        # later changes to the buffer do not affect the copy
+        self.fill(-1, 0, 0, 4, 4, (1, 1, 1, 255))
+
+        self.assertEqual((4, 4), self.display.screenshot(-1).size)
+        image = self.display.screenshot()
+        self.assertEqual((9, 9, 9, 255), image.getpixel((30, 10)))
+        self.assertEqual((9, 9, 9, 255), image.getpixel((33, 13)))
+        self.assertEqual((0, 0, 0, 0), image.getpixel((34, 14)))
+
+    def test_transfer(self):
+        """
+        Test XOR transfer function.
+        """
+        self.fill(0, 0, 0, 4, 4, (0x0F, 0xF0, 0xFF, 255))
+        self.fill(-1, 0, 0, 4, 4, (0xFF, 0xFF, 0x00, 128))
+        self.apply('transfer', -1, 0, 0, 4, 4, 0x6, 0, 0, 0)
+
+        image = self.display.screenshot()
+        self.assertEqual((0xF0, 0x0F, 0xFF, 255), image.getpixel((0, 0)))
+
+    def test_transfer_functions(self):
+        """
+        Test AND and inverted source transfer functions.
+        """
+        self.fill(0, 0, 0, 4, 4, (0x0F, 0xF0, 0xFF, 255))
+        self.fill(-1, 0, 0, 4, 4, (0xFF, 0x3C, 0x00, 255))
+        self.apply('transfer', -1, 0, 0, 2, 4, 0x1, 0, 0, 0)
+        self.apply('transfer', -1, 0, 0, 2, 4, 0xC, 0, 2, 0)
+
+        image = self.display.screenshot()
+        self.assertEqual((0x0F, 0x30, 0x00, 255), image.getpixel((0, 0)))
+        self.assertEqual((0x00, 0xC3, 0xFF, 255), image.getpixel((2, 0)))
+
+    def test_pending_bounded(self):
+        """
+        Test unqueried layer drops overwritten operations without drawing.
+        """
+        data = io.BytesIO()
+        Image.new('RGB', (8, 8), (1, 2, 3)).save(data, 'JPEG')
+        data = base64.b64encode(data.getvalue()).decode()
+
+        for i in range(1000):
+            self.fill(0, 0, 0, 16, 16, (i % 256, 0, 0, 255))
+            self.fill(0, 4, 4, 4, 4, (0, 0, 255, 128), mask=0xE)
+
+            self.apply('img', 1, 0xE, 0, 'image/jpeg', 20, 0)
+            self.apply('blob', 1, data)
+            self.apply('end', 1)
+
+        layer = self.display.layer(0)
+        self.assertIsNone(layer._image)
+        self.assertEqual(4, len(layer._pending))
+
+        # shrinking layer drops operations outside of it
+        self.apply('size', 0, 16, 16)
+        self.assertEqual(['size', 'fill', 'fill', 'size'],
+                         [op for op, _, _, _ in layer._pending])
+
+        image = self.display.screenshot()
+        self.assertEqual((231, 0, 0, 255), image.getpixel((0, 0)))
+
+    def test_buffer_pending_bounded(self):
+        """
+        Test unqueried buffer drops overwritten operations, and is drawn once
+        too much data is queued.
+        """
+        data = io.BytesIO()
+        Image.new('RGB', (8, 8), (1, 2, 3)).save(data, 'JPEG')
+        data = base64.b64encode(data.getvalue()).decode()
+
+        # e.g. cursor updates
+        for i in range(1000):
+            self.apply('img', 1, 0xC, -1, 'image/jpeg', 0, 0)
+            self.apply('blob', 1, data)
+            self.apply('end', 1)
+
+        layer = self.display.layer(-1)
+        self.assertIsNone(layer._image)
+        self.assertEqual(1, len(layer._pending))
+
+        # not replacing, drawn once MAX_BUFFER_PENDING is reached
+        with patch('guacamole.display.MAX_BUFFER_PENDING', 4096):
+            for i in range(1000):
+                self.apply('img', 1, 0xE, -1, 'image/jpeg', i % 8, 0)
+                self.apply('blob', 1, data)
+                self.apply('end', 1)
+
+        self.assertIsNotNone(layer._image)
+        self.assertLess(layer._pending_bytes, 4096)
+        layer.flush()
+        self.assertEqual((15, 8), layer._image.size)
+
+    def test_lazy_layers(self):
+        """
+        Test drawing is deferred until layer is queried.
+        """
+        self.fill(1, 0, 0, 4, 4, (9, 9, 9, 255))
+
+        layer = self.display.layer(1)
+        self.assertIsNone(layer._image)
+
+        self.display.screenshot(1)
+        self.assertIsNotNone(layer._image)
+
+    def test_thumbnail(self):
+        """
+        Test thumbnail is downscaled and cached until layer changes.
+        """
+        self.fill(0, 0, 0, 64, 32, (9, 9, 9, 255))
+
+        thumbnail = self.display.thumbnail(16, 16)
+        self.assertEqual((16, 8), thumbnail.size)
+        self.assertEqual((9, 9, 9, 255), thumbnail.getpixel((0, 0)))
+        self.assertIs(thumbnail, self.display.thumbnail(16, 16))
+
+        self.fill(0, 0, 0, 64, 32, (1, 1, 1, 255))
+        thumbnail = self.display.thumbnail(16, 16)
+        self.assertEqual((1, 1, 1, 255), thumbnail.getpixel((0, 0)))